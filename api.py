@@ -1,13 +1,59 @@
+import asyncio
 import json
-from fastapi import FastAPI, File, UploadFile, HTTPException, status
-from fastapi.responses import HTMLResponse
-from image_processor import process_image_to_json, bytes_to_base64
+import gzip
+import io
+from contextlib import asynccontextmanager
+import aiohttp
+import orjson
+from blake3 import blake3
+from cachetools import LRUCache
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request, status
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, Response
+from PIL import Image
+from image_processor import (
+    CONNECT_TIMEOUT,
+    FILE_API_MIN_BYTES,
+    REQUEST_DEADLINE,
+    build_payload_template,
+    delete_image_file,
+    downscale_image,
+    hash_stream,
+    process_image_to_json,
+    sniff_image_type,
+    stream_to_base64,
+    upload_image_file,
+)
 import os
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Opens one pooled HTTP client session for the Gemini API and closes it on shutdown."""
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=100, ttl_dns_cache=300, keepalive_timeout=75)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_DEADLINE, connect=CONNECT_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        app.state.http = session
+        yield
+
+
 app = FastAPI(
     title="Gemini ID Card Data Extractor",
-    description="An API to extract structured data from uploaded ID card images using the Gemini Vision Model."
+    description="An API to extract structured data from uploaded ID card images using the Gemini Vision Model.",
+    lifespan=lifespan
+)
+
+# Origins allowed to call the API from other sites, comma-separated in 'CORS_ALLOW_ORIGINS'
+# (none by default, so only the bundled page can use it)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=[origin.strip() for origin in os.getenv("CORS_ALLOW_ORIGINS", "").split(",") if origin.strip()],
+    allow_methods=["GET", "POST"],
+    allow_headers=["*"],
 )
+# Compress larger responses; the pre-gzipped index page is passed through as is
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 # Define the path to the HTML template file
 INDEX_HTML = "html/index.html" 
@@ -23,15 +69,26 @@ def get_html_content(file_path: str = INDEX_HTML) -> str:
         print(f"Error: HTML input form file not found at {file_path}")
         return "<h1>Error: HTML input form not found. Please ensure 'index.html' is in the same directory.</h1>"
 
+# The template is static, so read it once at startup and keep a gzipped copy
+INDEX_HTML_CONTENT = get_html_content().encode("utf-8")
+INDEX_HTML_GZIP = gzip.compress(INDEX_HTML_CONTENT, 9)
+INDEX_HTML_STATUS = 500 if b"Error: HTML input form not found" in INDEX_HTML_CONTENT else 200
+
 @app.get("/", response_class=HTMLResponse)
-async def root():
-    """Serves the main HTML interface for the application, reading content from index.html."""
-    html_content = get_html_content()
-    # If the content is the error message, use status 500
-    if "Error: HTML input form not found" in html_content:
-        return HTMLResponse(content=html_content, status_code=500)
-    
-    return HTMLResponse(content=html_content, status_code=200)
+async def root(request: Request):
+    """Serves the main HTML interface for the application from the copy of index.html read at startup."""
+    headers = {}
+    if INDEX_HTML_STATUS == 200:
+        headers["Cache-Control"] = "public, max-age=3600"
+
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        # GZipMiddleware passes already-encoded responses through without adding Vary,
+        # so set it here; on the plain path the middleware adds it itself
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+        return HTMLResponse(content=INDEX_HTML_GZIP, status_code=INDEX_HTML_STATUS, headers=headers)
+
+    return HTMLResponse(content=INDEX_HTML_CONTENT, status_code=INDEX_HTML_STATUS, headers=headers)
 
 
 # --- JSON Schema Definition ---
@@ -57,22 +114,29 @@ ANALYSIS_PROMPT = (
     "If a field is not present, return an empty string for that field."
 )
 
+# Serialized once; the schema dict is not walked again and only the image part
+# is spliced in per request
+ID_CARD_SCHEMA_JSON = orjson.dumps(ID_CARD_SCHEMA)
+ID_CARD_PAYLOAD = build_payload_template(ANALYSIS_PROMPT, ID_CARD_SCHEMA_JSON)
+
+# Uploads larger than this are rejected before any reading or encoding
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+
+# Extraction results keyed by a hash of the uploaded image bytes, so re-uploads of
+# the same image skip the Gemini call. Per-process; each worker keeps its own cache.
+RESULT_CACHE = LRUCache(maxsize=1024)
+
 
 @app.post("/extract")
-async def extract_id_data(file: UploadFile = File(...)):
+async def extract_id_data(request: Request, file: UploadFile = File(...), no_cache: bool = False):
     """
     Accepts an uploaded image file (ID card or Passport) and returns extracted data
-    in a structured JSON format using the Gemini API.
+    in a structured JSON format using the Gemini API. The model's JSON is passed
+    through as is rather than parsed and re-serialized.
+    Results for previously seen images are served from cache unless no_cache is set.
     """
     
-    # 1. Read file content from the upload
-    try:
-        # FastAPI's UploadFile reads the data into memory
-        contents = await file.read()
-    except Exception:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Could not read file content.")
-
-    # 2. Get MIME type
+    # 1. Get MIME type
     mime_type = file.content_type
     
     # Check if the content type is an image
@@ -82,22 +146,94 @@ async def extract_id_data(file: UploadFile = File(...)):
             detail=f"Invalid file type: {mime_type}. Only image files are supported."
         )
 
-    # 3. Convert bytes to base64
-    base64_data = bytes_to_base64(contents)
-    
-    if not base64_data:
+    # Reject oversized uploads before doing any work on them
+    if file.size and file.size > MAX_IMAGE_BYTES:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to encode image data for API submission."
+            status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+            detail=f"Image is too large ({file.size} bytes). The maximum is {MAX_IMAGE_BYTES} bytes."
         )
 
-    # 4. Call the Gemini Processor
-    structured_result = process_image_to_json(
-        image_base64=base64_data,
-        mime_type=mime_type,
-        prompt=ANALYSIS_PROMPT,
-        response_schema=ID_CARD_SCHEMA
-    )
+    # Check the actual content against known image signatures, and use the detected
+    # type rather than trusting the client-declared one
+    try:
+        header = await file.read(16)
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Could not read file content.")
+
+    mime_type = sniff_image_type(header)
+    if not mime_type:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Unsupported image content. Only JPEG, PNG, WebP and HEIC/HEIF images are supported."
+        )
+
+    session = request.app.state.http
+    hasher = blake3(max_threads=blake3.AUTO)
+    base64_data = None
+    uploaded = None
+
+    # 2. Hash the original upload for the cache key, before any resizing, so a cache hit
+    #    skips all further work. This and the image work below run in a worker thread
+    #    so the CPU work doesn't block other requests.
+    try:
+        await asyncio.to_thread(hash_stream, file.file, hasher)
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Could not read file content.")
+
+    cache_key = hasher.hexdigest(length=16)
+    if not no_cache and cache_key in RESULT_CACHE:
+        return Response(content=RESULT_CACHE[cache_key], media_type="application/json")
+
+    # 3. Shrink large photos to the resolution Gemini actually uses
+    try:
+        resized = await asyncio.to_thread(downscale_image, file.file, file.size)
+    except Image.DecompressionBombError as e:
+        raise HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=str(e))
+    if resized:
+        image_file, image_size, mime_type = io.BytesIO(resized), len(resized), "image/jpeg"
+    else:
+        image_file, image_size = file.file, file.size
+
+    # 4. Large images go to the Gemini File API as raw bytes; the rest (or any image whose
+    #    upload fails) are read in bounded chunks and inlined as base64
+    if FILE_API_MIN_BYTES and image_size and image_size >= FILE_API_MIN_BYTES:
+        image_file.seek(0)
+        image_bytes = await asyncio.to_thread(image_file.read)
+        uploaded = await upload_image_file(session, image_bytes, mime_type)
+        del image_bytes
+
+    if not uploaded:
+        try:
+            base64_data = await asyncio.to_thread(stream_to_base64, image_file)
+        except Exception:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Could not read file content.")
+
+        if not base64_data:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Failed to encode image data for API submission."
+            )
+
+    # 5. Call the Gemini Processor
+    try:
+        structured_result = await process_image_to_json(
+            session=session,
+            image_base64=base64_data,
+            mime_type=mime_type,
+            payload_template=ID_CARD_PAYLOAD,
+            file_uri=uploaded["uri"] if uploaded else None,
+            raw=True
+        )
+    finally:
+        # Don't leave the ID image stored on the File API side
+        if uploaded:
+            await delete_image_file(session, uploaded["name"])
+
+    if isinstance(structured_result, dict) and structured_result.get('error') == 'timeout':
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Gemini API did not respond in time."
+        )
 
     if isinstance(structured_result, dict) and structured_result.get('error'):
          # Extract the specific error message if available, otherwise use a generic message
@@ -106,9 +242,10 @@ async def extract_id_data(file: UploadFile = File(...)):
          raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=error_message)
 
 
-    # 5. Handle the result
+    # 6. Handle the result
     if structured_result:
-        return structured_result
+        RESULT_CACHE[cache_key] = structured_result
+        return Response(content=structured_result, media_type="application/json")
     else:
         # If the API returns None (due to failure or no content)
         raise HTTPException(
@@ -0,0 +1,18 @@
+"""
+Gunicorn settings for running the API with one Uvicorn worker per CPU core.
+
+Launch with:
+    gunicorn -c gunicorn_conf.py api:app
+
+Each worker runs the app's lifespan itself, so the aiohttp session (and the
+result cache) are created per worker after the fork. Keep preload_app off so
+no connection is opened in the master process and shared across forks.
+"""
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# Uses uvloop and httptools automatically when they are installed (uvicorn[standard])
+worker_class = "uvicorn_worker.UvicornWorker"
+preload_app = False
@@ -0,0 +1,22 @@
+"""
+Hypercorn settings for serving the API over HTTP/2, so a client's concurrent
+/extract uploads and page fetches share one multiplexed connection.
+
+Launch with:
+    hypercorn -c file:hypercorn_conf.py api:app
+
+Browsers only negotiate HTTP/2 over TLS, so either set TLS_CERTFILE and
+TLS_KEYFILE (which also enables HTTP/3 on QUIC_BIND) or put an h2-capable
+TLS-terminating proxy in front.
+"""
+import multiprocessing
+import os
+
+bind = [os.getenv("BIND", "0.0.0.0:8000")]
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvloop"
+
+certfile = os.getenv("TLS_CERTFILE")
+keyfile = os.getenv("TLS_KEYFILE")
+if certfile and keyfile:
+    quic_bind = [os.getenv("QUIC_BIND", "0.0.0.0:8443")]
@@ -1,9 +1,16 @@
-import requests
-import json
-import base64
-import time
+import aiohttp
+import asyncio
+import io
+import math
+import orjson
+import pybase64
 import os
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
+from PIL import Image, ImageOps
 
 # Load environment variables from a .env file (if it exists)
 load_dotenv()
@@ -14,112 +21,343 @@ API_KEY = os.getenv("GEMINI_API_KEY", "")
 API_URL_BASE = "https://generativelanguage.googleapis.com/v1beta/models/"
 MODEL_NAME = "gemini-2.5-flash-preview-09-2025"
 API_URL = f"{API_URL_BASE}{MODEL_NAME}:generateContent?key={API_KEY}"
+FILES_URL_BASE = "https://generativelanguage.googleapis.com/v1beta/"
+FILES_UPLOAD_URL = f"https://generativelanguage.googleapis.com/upload/v1beta/files?key={API_KEY}"
+
+# Timeouts (seconds) for Gemini calls: per-attempt connect and read limits, and an
+# overall budget shared by all retries of one request.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+REQUEST_DEADLINE = 60
+
+# Images of at least this many bytes are sent as raw bytes through the Gemini File API
+# instead of being inlined as base64 (saves the encode and ~25% of the request body).
+# Read from 'GEMINI_FILE_API_MIN_BYTES'; 0 (the default) always inlines.
+FILE_API_MIN_BYTES = int(os.getenv("GEMINI_FILE_API_MIN_BYTES", "0"))
+
+# The System Instruction (Model's Role), sent with every request
+SYSTEM_INSTRUCTION = (
+    "You are an expert visual data extractor and summarizer. "
+    "Your task is to analyze the provided image and generate a concise, "
+    "accurate JSON object that strictly adheres to the given schema and "
+    "answers the user's prompt. Do not include any external commentary."
+)
+
+# Stand in for the per-request image part and the pre-serialized response schema
+# while the static payload is serialized
+IMAGE_PART_PLACEHOLDER = "__IMAGE_PART__"
+SCHEMA_PLACEHOLDER = "__RESPONSE_SCHEMA__"
+
+# Read size for streamed uploads. A multiple of 3 so every chunk encodes to
+# base64 without padding and the pieces can simply be concatenated.
+BASE64_CHUNK_SIZE = 57 * 1024
+
+# Read size when hashing uploads. Large enough for BLAKE3 to spread each update
+# across threads and SIMD lanes.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Gemini downsamples images internally, so larger photos are resized to this long
+# edge and re-encoded as JPEG before sending. Images already within the edge limit
+# and under DOWNSCALE_MIN_BYTES are sent untouched.
+MAX_IMAGE_EDGE = 1568
+DOWNSCALE_MIN_BYTES = 512 * 1024
+JPEG_QUALITY = 85
+
+# Decoding cost grows with pixel count, not file size (a 410 KB PNG can be 144 MP),
+# so images with more pixels than this are rejected before they are decoded.
+MAX_IMAGE_PIXELS = 40_000_000
+
+# Leading magic bytes of the image formats Gemini accepts, checked against the
+# first bytes of an upload before any heavier processing
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+)
+HEIF_BRANDS = {
+    b"heic": "image/heic", b"heix": "image/heic", b"heim": "image/heic", b"heis": "image/heic",
+    b"mif1": "image/heif", b"msf1": "image/heif", b"heif": "image/heif",
+}
 
 # --- Utility Functions ---
 
-def bytes_to_base64(image_bytes: bytes) -> str:
+def sniff_image_type(header: bytes) -> str | None:
     """
-    Converts raw image bytes to a base64 encoded string.
-    This is used to prepare the image for the Gemini API payload.
+    Identifies JPEG, PNG, WebP and HEIC/HEIF images from their first 16 bytes.
+    Returns the matching MIME type, or None if the data is not a supported image.
     """
-    encoded_string = base64.b64encode(image_bytes).decode("utf-8")
-    return encoded_string
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return mime_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header[4:8] == b"ftyp":
+        return HEIF_BRANDS.get(header[8:12])
+    return None
 
-# --- Main Function ---
+def downscale_image(stream, size: int | None) -> bytes | None:
+    """
+    Resizes a photo from a seekable binary file object so its long edge is at most
+    MAX_IMAGE_EDGE and re-encodes it as JPEG. Only the header is read to decide,
+    so images that are already small enough cost almost nothing.
 
-def process_image_to_json(
-    image_base64: str,
-    mime_type: str,
-    prompt: str,
-    response_schema: dict,
-    max_retries: int = 5
-) -> dict | None:
+    This is blocking CPU work; call it via asyncio.to_thread from async code.
+
+    Raises:
+        Image.DecompressionBombError: If the image has more than MAX_IMAGE_PIXELS pixels.
+
+    Returns:
+        The JPEG bytes, or None if the original should be sent as is (already small,
+        not decodable by Pillow such as HEIC, or not smaller after re-encoding).
     """
-    Uses the Gemini API to analyze an image based on a prompt and return 
-    the result structured according to the provided JSON schema.
+    stream.seek(0)
+    try:
+        with Image.open(stream) as image:
+            if image.width * image.height > MAX_IMAGE_PIXELS:
+                raise Image.DecompressionBombError(
+                    f"Image has {image.width * image.height} pixels, more than the {MAX_IMAGE_PIXELS} allowed."
+                )
+            if max(image.size) <= MAX_IMAGE_EDGE and size and size <= DOWNSCALE_MIN_BYTES:
+                return None
 
-    Args:
-        image_base64: The base64-encoded string of the image data.
-        mime_type: The MIME type of the image (e.g., 'image/jpeg', 'image/png').
-        prompt: The specific question or task for the model regarding the image.
-        response_schema: The JSON schema dictionary defining the required output structure.
-        max_retries: Maximum number of retries for the API call (for backoff).
+            # Let JPEG decode at a reduced scale, then shrink before applying the EXIF
+            # orientation (dropped on re-encode), so no full-size copy is ever made
+            image.draft("RGB", (MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+            image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.LANCZOS)
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    except (OSError, ValueError) as e:
+        print(f"Could not downscale the image, sending it unchanged: {e}")
+        return None
+
+    resized = output.getvalue()
+    if size and len(resized) >= size:
+        return None
+    return resized
+
+def stream_to_base64(stream, chunk_size: int = BASE64_CHUNK_SIZE) -> bytearray:
+    """
+    Reads a seekable binary file object (e.g. UploadFile.file, a SpooledTemporaryFile)
+    from the start in fixed-size chunks and base64-encodes it incrementally, so the
+    raw image is never held in memory alongside its encoded copy. The result stays
+    as bytes since it is spliced straight into the request body.
+
+    This is blocking CPU work; call it via asyncio.to_thread from async code.
+    """
+    stream.seek(0)
+    encoded = bytearray()
+    while chunk := stream.read(chunk_size):
+        encoded += pybase64.b64encode(chunk)
+    return encoded
+
+def hash_stream(stream, hasher, chunk_size: int = HASH_CHUNK_SIZE) -> None:
+    """Feeds a seekable binary file object to a hashlib-style (or blake3) hasher from the start, in fixed-size chunks (blocking)."""
+    stream.seek(0)
+    while chunk := stream.read(chunk_size):
+        hasher.update(chunk)
+
+async def upload_image_file(
+    session: aiohttp.ClientSession,
+    image: bytes,
+    mime_type: str
+) -> dict | None:
+    """
+    Uploads raw image bytes to the Gemini File API, so they can be referenced by
+    URI instead of being inlined as base64. Pass bytes rather than a file object:
+    aiohttp calls fileno() on files, which rolls a SpooledTemporaryFile to disk.
 
     Returns:
-        A dictionary (the parsed JSON response) or None if the call fails.
+        The File resource (with 'name' and 'uri') or None if the upload fails.
     """
-    # 1. Check for API Key
-    if not API_KEY:
-        print("Error: API Key is missing. Please set GEMINI_API_KEY in your environment or .env file.")
-        return {"error": "API Key is missing"}, 401
+    start_headers = {
+        "X-Goog-Upload-Protocol": "resumable",
+        "X-Goog-Upload-Command": "start",
+        "X-Goog-Upload-Header-Content-Length": str(len(image)),
+        "X-Goog-Upload-Header-Content-Type": mime_type,
+    }
+    upload_headers = {
+        "Content-Length": str(len(image)),
+        "X-Goog-Upload-Offset": "0",
+        "X-Goog-Upload-Command": "upload, finalize",
+    }
+    try:
+        async with session.post(FILES_UPLOAD_URL, headers=start_headers, json={"file": {"display_name": "id-card"}}) as response:
+            response.raise_for_status()
+            upload_url = response.headers["X-Goog-Upload-URL"]
+
+        async with session.post(upload_url, headers=upload_headers, data=image) as response:
+            response.raise_for_status()
+            result = await response.json()
+            return result["file"]
+    except (aiohttp.ClientError, asyncio.TimeoutError, KeyError) as e:
+        print(f"Error uploading the image to the Gemini File API: {e}")
+        return None
+
+async def delete_image_file(session: aiohttp.ClientSession, name: str) -> None:
+    """Deletes an uploaded file (e.g. 'files/abc123') so the ID image is not kept by the File API."""
+    try:
+        async with session.delete(f"{FILES_URL_BASE}{name}?key={API_KEY}") as response:
+            response.raise_for_status()
+    except aiohttp.ClientError as e:
+        print(f"Error deleting uploaded file {name}: {e}")
+
+# --- Main Function ---
+
+def retry_wait_time(retry_after: str | None, attempt: int) -> float:
+    """
+    Returns how many seconds to wait before retrying a Gemini call. Uses the server's
+    Retry-After hint (delay in seconds or an HTTP date) when it is valid, otherwise
+    capped exponential backoff with jitter, so concurrent requests don't retry in lockstep.
+    """
+    if retry_after:
+        try:
+            wait_time = float(retry_after)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                wait_time = max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+            except (TypeError, ValueError):
+                wait_time = None
+        # Rejects nan/inf (asyncio.sleep(nan) never returns) and negative values
+        if wait_time is not None and math.isfinite(wait_time) and wait_time >= 0:
+            return wait_time
+    return min(2 ** attempt, 30) + random.uniform(0, 1)
 
-    # 2. Define the System Instruction (Model's Role)
-    system_instruction = (
-        "You are an expert visual data extractor and summarizer. "
-        "Your task is to analyze the provided image and generate a concise, "
-        "accurate JSON object that strictly adheres to the given schema and "
-        "answers the user's prompt. Do not include any external commentary."
-    )
+def build_payload_template(prompt: str, response_schema: bytes) -> tuple[bytes, bytes]:
+    """
+    Serializes the parts of the API payload that do not change between requests
+    (prompt, system instruction and response schema) once, returning the JSON that
+    goes before and after the image part. Build this at import time for a fixed
+    prompt and schema and pass it to process_image_to_json.
 
-    # 3. Construct the API Payload
+    The response schema is given already serialized (e.g. orjson.dumps(SCHEMA)) and
+    is spliced in as raw bytes, so its dict is never walked again.
+    """
     payload = {
         "contents": [
             {
                 "role": "user",
                 "parts": [
                     {"text": prompt},
-                    {
-                        "inlineData": {
-                            "mimeType": mime_type,
-                            "data": image_base64
-                        }
-                    }
+                    IMAGE_PART_PLACEHOLDER
                 ]
             }
         ],
         "systemInstruction": {
-            "parts": [{"text": system_instruction}]
+            "parts": [{"text": SYSTEM_INSTRUCTION}]
         },
         "generationConfig": {
             "responseMimeType": "application/json",
-            "responseSchema": response_schema
+            "responseSchema": SCHEMA_PLACEHOLDER
         }
     }
+    serialized = orjson.dumps(payload).replace(orjson.dumps(SCHEMA_PLACEHOLDER), response_schema)
+    prefix, suffix = serialized.split(orjson.dumps(IMAGE_PART_PLACEHOLDER))
+    return prefix, suffix
+
+def build_request_body(
+    payload_template: tuple[bytes, bytes],
+    mime_type: str,
+    image_base64: bytes | None,
+    file_uri: str | None = None
+) -> bytes:
+    """
+    Splices the per-request image part (inline base64 data, or a File API URI)
+    into a template from build_payload_template, giving the full JSON request body.
+    """
+    prefix, suffix = payload_template
+    mime_json = orjson.dumps(mime_type)
+    if file_uri:
+        return b"".join([prefix, b'{"fileData":{"mimeType":', mime_json, b',"fileUri":', orjson.dumps(file_uri), b'}}', suffix])
+    return b"".join([prefix, b'{"inlineData":{"mimeType":', mime_json, b',"data":"', image_base64, b'"}}', suffix])
 
-    # 4. Perform the API Call with Exponential Backoff
+async def process_image_to_json(
+    session: aiohttp.ClientSession,
+    image_base64: bytes | None,
+    mime_type: str,
+    payload_template: tuple[bytes, bytes],
+    max_retries: int = 5,
+    file_uri: str | None = None,
+    raw: bool = False
+) -> dict | bytes | None:
+    """
+    Uses the Gemini API to analyze an image based on a prompt and return 
+    the result structured according to the provided JSON schema.
+
+    Args:
+        session: The shared aiohttp client session used to reach the Gemini API.
+        image_base64: The base64-encoded image data as ASCII bytes (None when file_uri is given).
+        mime_type: The MIME type of the image (e.g., 'image/jpeg', 'image/png').
+        payload_template: The pre-serialized prompt and schema from build_payload_template.
+        max_retries: Maximum number of retries for the API call (for backoff).
+        file_uri: URI of an image already uploaded via upload_image_file, used instead of inline data.
+        raw: Return the model's JSON text as UTF-8 bytes (still checked to be valid JSON),
+            for callers that only pass it on.
+
+    Returns:
+        A dictionary (the parsed JSON response) or its raw bytes if raw is set,
+        {"error": "timeout"} if the REQUEST_DEADLINE budget runs out, or None if the call fails.
+    """
+    # 1. Check for API Key
+    if not API_KEY:
+        print("Error: API Key is missing. Please set GEMINI_API_KEY in your environment or .env file.")
+        return {"error": "API Key is missing"}
+
+    # 2. Splice the image part into the pre-serialized payload
+    body = build_request_body(payload_template, mime_type, image_base64, file_uri)
+
+    # 3. Perform the API Call with Exponential Backoff, bounded by an overall deadline
+    deadline = time.monotonic() + REQUEST_DEADLINE
     for attempt in range(max_retries):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        timeout = aiohttp.ClientTimeout(total=remaining, connect=CONNECT_TIMEOUT, sock_read=min(READ_TIMEOUT, remaining))
         try:
-            response = requests.post(
-                API_URL, 
-                headers={'Content-Type': 'application/json'},
-                data=json.dumps(payload)
-            )
-            response.raise_for_status() # Raises an HTTPError for bad responses (4xx or 5xx)
-
-            result = response.json()
+            async with session.post(API_URL, headers={'Content-Type': 'application/json'}, data=body, timeout=timeout) as response:
+                response.raise_for_status() # Raises a ClientResponseError for bad responses (4xx or 5xx)
+
+                result = orjson.loads(await response.read())
             
             # Check for content in the response structure
             candidate = result.get('candidates', [{}])[0]
             if candidate and candidate.get('content') and candidate['content'].get('parts'):
                 json_string = candidate['content']['parts'][0]['text']
                 # The model returns a string that represents the JSON structure, so we parse it.
-                return json.loads(json_string)
+                # In raw mode the parse only validates it (e.g. against truncated output) and
+                # the text itself is returned.
+                structured_result = orjson.loads(json_string)
+                if raw:
+                    return json_string.encode("utf-8")
+                return structured_result
             else:
                 return None
 
-        except requests.exceptions.HTTPError as e:
-            if response.status_code in [429, 500, 503] and attempt < max_retries - 1:
+        except aiohttp.ClientResponseError as e:
+            if e.status in [429, 500, 503] and attempt < max_retries - 1:
                 # Retry on rate limit (429) or server errors (500, 503)
-                wait_time = 2 ** attempt
-                time.sleep(wait_time)
+                wait_time = retry_wait_time(e.headers.get("Retry-After") if e.headers else None, attempt)
+                if wait_time >= deadline - time.monotonic():
+                    # Gemini answered, but asks us to wait longer than the budget allows
+                    print(f"HTTP Error {e.status}; retry wait of {wait_time:.1f}s exceeds the remaining time budget.")
+                    return None
+                await asyncio.sleep(wait_time)
             else:
                 print(f"Fatal HTTP error or failed after max retries: {e}")
                 return None
-        except requests.exceptions.RequestException as e:
+        except asyncio.TimeoutError:
+            # A hung connection or slow response; try again while the budget allows
+            print(f"Gemini API request timed out (Attempt {attempt + 1}/{max_retries}).")
+        except aiohttp.ClientError as e:
             print(f"An error occurred during the API request: {e}")
             return None
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"Error decoding the JSON response from the model: {e}")
             return None
 
-    return None
\ No newline at end of file
+    # Only reached when the deadline passed or every attempt timed out
+    print("Gemini API call ran out of time before returning a structured response.")
+    return {"error": "timeout"}
\ No newline at end of file
@@ -1,147 +1,10 @@
-import requests
+import aiohttp
+import asyncio
 import json
-import base64
-import time
 import os
 import random
-from dotenv import load_dotenv # NEW: Import load_dotenv
-
-# Load environment variables from a .env file (if it exists)
-# The .env file should contain a line like: GEMINI_API_KEY="YOUR_API_KEY"
-load_dotenv()
-
-# --- Configuration ---
-# Read API Key from environment variable 'GEMINI_API_KEY'.
-# It will check the system environment first, and then the variables loaded from .env.
-API_KEY = os.getenv("GEMINI_API_KEY", "")
-API_URL_BASE = "https://generativelanguage.googleapis.com/v1beta/models/"
-MODEL_NAME = "gemini-2.5-flash-preview-09-2025"
-API_URL = f"{API_URL_BASE}{MODEL_NAME}:generateContent?key={API_KEY}"
-
-# --- Utility Functions ---
-
-def image_to_base64(image_path: str, mime_type: str = "image/jpeg") -> str | None:
-    """
-    Converts a local image file to a base64 encoded string.
-    This simulates how image data needs to be passed to the Gemini API.
-    
-    NOTE: For this example to run, you must replace 'path/to/your/image.jpg' with a 
-    valid image file path on your system.
-    """
-    try:
-        with open(image_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-        return encoded_string
-    except FileNotFoundError:
-        print(f"Error: Image file not found at {image_path}")
-        return None
-    except Exception as e:
-        print(f"An error occurred while reading the image: {e}")
-        return None
-
-# --- Main Function ---
-
-def process_image_to_json(
-    image_base64: str,
-    mime_type: str,
-    prompt: str,
-    response_schema: dict,
-    max_retries: int = 5
-) -> dict | None:
-    """
-    Uses the Gemini API to analyze an image based on a prompt and return 
-    the result structured according to the provided JSON schema.
-
-    Args:
-        image_base64: The base64-encoded string of the image data.
-        mime_type: The MIME type of the image (e.g., 'image/jpeg', 'image/png').
-        prompt: The specific question or task for the model regarding the image.
-        response_schema: The JSON schema dictionary defining the required output structure.
-        max_retries: Maximum number of retries for the API call (for backoff).
-
-    Returns:
-        A dictionary (the parsed JSON response) or None if the call fails.
-    """
-    # 1. Check for API Key
-    if not API_KEY:
-        print("Error: API Key is missing. Please set GEMINI_API_KEY in your environment or .env file.")
-        return None
-
-    # 2. Define the System Instruction (Model's Role)
-    system_instruction = (
-        "You are an expert visual data extractor and summarizer. "
-        "Your task is to analyze the provided image and generate a concise, "
-        "accurate JSON object that strictly adheres to the given schema and "
-        "answers the user's prompt. Do not include any external commentary."
-    )
-
-    # 3. Construct the API Payload
-    payload = {
-        "contents": [
-            {
-                "role": "user",
-                "parts": [
-                    {"text": prompt},
-                    {
-                        "inlineData": {
-                            "mimeType": mime_type,
-                            "data": image_base64
-                        }
-                    }
-                ]
-            }
-        ],
-        "systemInstruction": {
-            "parts": [{"text": system_instruction}]
-        },
-        "generationConfig": {
-            "responseMimeType": "application/json",
-            "responseSchema": response_schema
-        }
-    }
-
-    # 4. Perform the API Call with Exponential Backoff
-    for attempt in range(max_retries):
-        try:
-            print(f"Attempting API call (Attempt {attempt + 1}/{max_retries})...")
-            response = requests.post(
-                API_URL, 
-                headers={'Content-Type': 'application/json'},
-                data=json.dumps(payload)
-            )
-            response.raise_for_status() # Raises an HTTPError for bad responses (4xx or 5xx)
-
-            result = response.json()
-            
-            # Check for content in the response structure
-            candidate = result.get('candidates', [{}])[0]
-            if candidate and candidate.get('content') and candidate['content'].get('parts'):
-                json_string = candidate['content']['parts'][0]['text']
-                # The model returns a string that represents the JSON structure, so we parse it.
-                return json.loads(json_string)
-            else:
-                print("API response received but contained no generated content.")
-                return None
-
-        except requests.exceptions.HTTPError as e:
-            if response.status_code in [429, 500, 503] and attempt < max_retries - 1:
-                # Retry on rate limit (429) or server errors (500, 503)
-                wait_time = 2 ** attempt
-                print(f"HTTP Error {response.status_code}. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-            else:
-                print(f"Fatal HTTP error or failed after max retries: {e}")
-                print(f"API Response Text: {response.text}")
-                return None
-        except requests.exceptions.RequestException as e:
-            print(f"An error occurred during the API request: {e}")
-            return None
-        except json.JSONDecodeError as e:
-            print(f"Error decoding the JSON response from the model: {e}")
-            return None
-
-    print("Max retries reached. Failed to get a structured response.")
-    return None
+import orjson
+from image_processor import build_payload_template, process_image_to_json, stream_to_base64
 
 # --- Example Usage ---
 
@@ -175,7 +38,8 @@ if __name__ == "__main__":
         print(f"Also, ensure you have python-dotenv installed (`pip install python-dotenv`) and a .env file is present.")
     else:
         print(f"Attempting to encode image from: {MOCK_IMAGE_PATH}")
-        base64_data = image_to_base64(MOCK_IMAGE_PATH, IMAGE_MIME_TYPE)
+        with open(MOCK_IMAGE_PATH, "rb") as image_file:
+            base64_data = stream_to_base64(image_file)
 
         if base64_data:
             # --- STEP 3: Define the Prompt ---
@@ -188,13 +52,17 @@ if __name__ == "__main__":
 
             # --- STEP 4: Call the Processor ---
             print("\n--- Starting Gemini API structured VLM call for ID Analysis ---")
-            
-            structured_result = process_image_to_json(
-                image_base64=base64_data,
-                mime_type=IMAGE_MIME_TYPE,
-                prompt=analysis_prompt,
-                response_schema=ID_CARD_SCHEMA
-            )
+
+            async def run_analysis():
+                async with aiohttp.ClientSession() as session:
+                    return await process_image_to_json(
+                        session=session,
+                        image_base64=base64_data,
+                        mime_type=IMAGE_MIME_TYPE,
+                        payload_template=build_payload_template(analysis_prompt, orjson.dumps(ID_CARD_SCHEMA))
+                    )
+
+            structured_result = asyncio.run(run_analysis())
 
             # --- STEP 5: Print the Result ---
             print("\n--- Final Structured ID Card Data ---")
@@ -0,0 +1,64 @@
+import base64
+import tempfile
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import orjson
+
+from image_processor import (
+    BASE64_CHUNK_SIZE,
+    SYSTEM_INSTRUCTION,
+    build_payload_template,
+    build_request_body,
+    retry_wait_time,
+    stream_to_base64,
+)
+
+PROMPT = "Extract the \"Name\" from this ID."
+SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"Name": {"type": "STRING", "description": "The full name of the person."}},
+    "required": ["Name"],
+}
+
+
+def full_payload(image_part: dict) -> dict:
+    return {
+        "contents": [{"role": "user", "parts": [{"text": PROMPT}, image_part]}],
+        "systemInstruction": {"parts": [{"text": SYSTEM_INSTRUCTION}]},
+        "generationConfig": {"responseMimeType": "application/json", "responseSchema": SCHEMA},
+    }
+
+
+def test_spliced_body_matches_serialized_payload():
+    template = build_payload_template(PROMPT, orjson.dumps(SCHEMA))
+
+    inline_body = build_request_body(template, "image/jpeg", b"QUJDRA==")
+    assert inline_body == orjson.dumps(full_payload({"inlineData": {"mimeType": "image/jpeg", "data": "QUJDRA=="}}))
+
+    file_body = build_request_body(template, "image/png", None, file_uri="https://example.com/files/abc")
+    assert file_body == orjson.dumps(full_payload({"fileData": {"mimeType": "image/png", "fileUri": "https://example.com/files/abc"}}))
+
+
+def test_stream_to_base64_matches_whole_input_encoding():
+    # Lengths around the chunk size and a multi-chunk input, to cover chunk boundaries
+    data = bytes(range(256)) * 1000
+    for length in (0, 1, 2, 3, BASE64_CHUNK_SIZE - 1, BASE64_CHUNK_SIZE, BASE64_CHUNK_SIZE + 1, len(data)):
+        stream = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        stream.write(data[:length])
+        assert stream_to_base64(stream) == base64.b64encode(data[:length])
+
+
+def test_retry_wait_time_uses_valid_retry_after():
+    assert retry_wait_time("3", attempt=0) == 3.0
+    assert retry_wait_time("0.5", attempt=4) == 0.5
+
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=20)
+    assert 15 <= retry_wait_time(format_datetime(retry_at, usegmt=True), attempt=0) <= 20
+    assert retry_wait_time("Wed, 21 Oct 2015 07:28:00 GMT", attempt=0) == 0.0
+
+
+def test_retry_wait_time_falls_back_to_backoff_on_invalid_retry_after():
+    for retry_after in (None, "", "nan", "inf", "-inf", "-5", "soon", "Mon, 99 Foo"):
+        assert 4 <= retry_wait_time(retry_after, attempt=2) <= 5
+    assert 30 <= retry_wait_time("nan", attempt=10) <= 31